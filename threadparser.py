@@ -28,6 +28,7 @@ import collections
 import datetime
 import fileinput
 import json
+import multiprocessing
 import pprint
 import re
 
@@ -41,12 +42,126 @@ except ImportError:
    # OKP's time stamps are WAY off, but by a constant amount (I hope)
    get_default_time_offset = lambda: datetime.timedelta(0, 3757)
 
+# Thread metadata, and the ordinal suffixes in "Member since" dates
+_TITLE_RE = re.compile(
+   r'<strong>\s*"((?:[^"<\n]|"(?!\s*</strong>))*)"\s*</strong>')
+_FORUM_RE = re.compile(r'forum=(\d+)')
+_TOPIC_RE = re.compile(r'topic_id=(\d+)')
+_ORDINAL_RE = re.compile(r'st|nd|rd|th')
+
+# Avatars worth keeping: absolute image URLs
+_AVATAR_RE = re.compile(r'http.*(?:jpg|gif|png)\Z', re.IGNORECASE)
+
+# Looked up once rather than per reply
+_TIME_OFFSET = get_default_time_offset()
+
+def reply_url_prefix(forum_id, topic_id):
+   """ Returns REPLY_URL for the given thread, up to but not including the
+   '#' and message id. The ids may be ints or the strings parsed from the
+   HTML. """
+
+   return REPLY_URL.rsplit('#', 1)[0] % (int(forum_id), int(topic_id))
+
+_MONTHS = dict((month, i) for i, month in enumerate(
+   ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+    'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1))
+
+def _parse_date(s):
+   """ Parses an OKP date stamp like "Jan-03-09 02:16 AM". Same result as
+   strptime(s, "%b-%d-%y %I:%M %p"), but slices the fixed width fields
+   directly. Anything unexpected goes to strptime. """
+
+   try:
+      if not (len(s) == 18 and s[3] == s[6] == '-' and s[9] == s[15] == ' '
+              and s[12] == ':'
+              and (s[4:6] + s[7:9] + s[10:12] + s[13:15]).isdigit()):
+         raise ValueError(s)
+      year = int(s[7:9])
+      year += 2000 if year < 69 else 1900
+      hour = int(s[10:12])
+      if not 1 <= hour <= 12:
+         raise ValueError(s)
+      hour %= 12
+      if s[16:] == 'PM':
+         hour += 12
+      elif s[16:] != 'AM':
+         raise ValueError(s)
+      return datetime.datetime(year, _MONTHS[s[:3]], int(s[4:6]),
+                               hour, int(s[13:15]))
+   except (KeyError, ValueError):
+      return datetime.datetime.strptime(s, "%b-%d-%y %I:%M %p")
+
+def _parse_join_date(s):
+   """ Parses the date from an author's "Member since" line, like
+   "Mar 01st 2005". The day's ordinal suffix is sliced off rather than
+   stripped with a regex. Anything unexpected goes to strptime. """
+
+   try:
+      month, day, year = s.split(' ')
+      if day[-2:] in ('st', 'nd', 'rd', 'th'):
+         day = day[:-2]
+      if not (len(day) <= 2 and len(year) == 4 and (day + year).isdigit()):
+         raise ValueError(s)
+      return datetime.datetime(int(year), _MONTHS[month], int(day))
+   except (KeyError, ValueError):
+      return datetime.datetime.strptime(_ORDINAL_RE.sub('', s), '%b %d %Y')
+
+_DATE_CACHE = {}
+_DATE_CACHE_SIZE = 256
+
+def _reply_date(s):
+   """ Returns the corrected time of a reply from its OKP date stamp, with
+   _TIME_OFFSET already applied. Recent stamps are remembered, since busy
+   threads get many replies in the same minute. """
+
+   try:
+      return _DATE_CACHE[s]
+   except KeyError:
+      pass
+
+   date = _parse_date(s) + _TIME_OFFSET
+
+   if len(_DATE_CACHE) >= _DATE_CACHE_SIZE:
+      _DATE_CACHE.clear()
+   _DATE_CACHE[s] = date
+   return date
+
+
+def compile_tokenizers(tokenizers, type_ids):
+   """ Joins a list of tokenizer patterns into a single alternation. Returns
+   the compiled regex along with a dict mapping each group index (as reported
+   by match.lastindex) to the (token type, group index) pairs of the
+   alternative it belongs to. Group names are translated to token types via
+   the type_ids dict, once, here. """
+
+   combined = re.compile('|'.join(tokenizers))
+
+   groups = {}
+   offset = 0
+   for tokenizer in tokenizers:
+      pattern = re.compile(tokenizer)
+      names = pattern.groupindex
+
+      # Group indexes are only right if every capturing group is a named one
+      assert pattern.groups == len(names), \
+         'tokenizer has an unnamed capturing group: %s' % tokenizer
+
+      found = sorted(
+         ((type_ids[name], offset + index)
+          for name, index in names.iteritems()),
+         key = lambda x: x[1])
+      for type, index in found:
+         groups[index] = found
+      offset += pattern.groups
+
+   return combined, groups
+
 
 class Token(object):
 
    """
-      This class represents a "token" in the post, which is simply a piece of
-      data - an author, an avatar url, a post title... Pretty much any
+      This class describes the "tokens" in a post. A token is simply a piece
+      of data - an author, an avatar url, a post title... Pretty much any
       information we hope to glean from the thread.
 
       Tokens are parsed via well-tested regular expressions. That means this
@@ -54,48 +169,77 @@ class Token(object):
       code may break in a hurry. Test early and often.
    """
 
-   # Token type constants
-   MESG_ID = 'MESG_ID'
-   MESG_TITLE = 'MESG_TITLE'
-   MESG_PARENT = 'MESG_PARENT'
-   MESG_TEXT = 'MESG_TEXT'
-   MESG_DATE = 'MESG_DATE'
-   MESG_NUM = 'MESG_NUM'
-   AUTHOR_NAME = 'AUTHOR_NAME'
-   AUTHOR_AVATAR = 'AUTHOR_AVATAR'
-   AUTHOR_ID = 'AUTHOR_ID'
-   AUTHOR_CHARTER = 'AUTHOR_CHARTER'
-   AUTHOR_NEWBIE = 'AUTHOR_NEWBIE'
-   AUTHOR_POSTS = 'AUTHOR_POSTS'
-   BREAKER = 'BREAKER'
-
-   tokenizers = {
-      MESG_ID        : re.compile(r'a name="(\d+)"'),
-      MESG_TITLE     : re.compile(r'<strong>.*?"(.*?)"</strong>'),
-      MESG_NUM       : re.compile(r'<strong>(\d+).*?".*?"</strong>'),
-      MESG_TEXT      : re.compile(r'<p class="dcmessage">(.*?)</p>', re.DOTALL),
-      MESG_DATE      : re.compile(r'class="dcdate">(.*?)<'),
-      MESG_PARENT    : re.compile(r'Reply # (\d+)'),
-      AUTHOR_AVATAR  : re.compile(r'src="(.*?)" height="60"'),
-      AUTHOR_CHARTER : re.compile(r'class="dcauthorinfo">(Charter member)<'),
-      AUTHOR_NEWBIE  : re.compile(r'class="dcauthorinfo">Member since (.*?)<'),
-      AUTHOR_POSTS   : re.compile(r'class="dcauthorinfo">.*?(\d+) post'),
-      AUTHOR_ID      : re.compile(r'user_profiles&u_id=(.*?)"\s*?class') ,
-      AUTHOR_NAME    : re.compile(r'class="dcauthorlink">(.*?)<'),
-      BREAKER        : re.compile(r'(Printer-friendly copy)'),
-   }
-
-   def __init__(self, type, data, position):
-      self.type = type
-      self.data = data
-      self.position = position
-
-   def __str__(self):
-      s = ''
-      s += 'TYPE: %s\n' % self.type
-      s += 'DATA: %s\n' % self.data[:60]
-      s += 'POS:  %s\n' % self.position
-      return s
+   # Token type constants. Small ints keep type checks and handler lookups
+   # cheap.
+   MESG_ID = 0
+   MESG_TITLE = 1
+   MESG_PARENT = 2
+   MESG_TEXT = 3
+   MESG_DATE = 4
+   MESG_NUM = 5
+   AUTHOR_NAME = 6
+   AUTHOR_AVATAR = 7
+   AUTHOR_ID = 8
+   AUTHOR_CHARTER = 9
+   AUTHOR_NEWBIE = 10
+   AUTHOR_POSTS = 11
+
+   # Reliably marks the end of every post. The thread is split on it before
+   # anything is tokenized.
+   breaker = 'Printer-friendly copy'
+
+   # Every tokenizer is an alternative in one big regular expression, so the
+   # HTML of a post is scanned exactly once. Data is captured in groups named
+   # after the token type. Tokenizers that would overlap in the HTML (title
+   # and number share a <strong>, the dcauthorinfo spans) are folded into a
+   # single alternative, and trailing context sits in lookaheads so that one
+   # token never swallows the start of the next. Keep every tokenizer starting
+   # with a literal character: that lets the regex engine skip quickly through
+   # the HTML between tokens.
+   #
+   # No lazy .*? here. Untrusted HTML goes through these, so every repeat is
+   # \d+, \s*, or a negated or tempered character class that stops at a
+   # character (<, > or ") found in the tokenizer's own literal prefix. Each
+   # prefix holds non-digits and no whitespace, so no repeat can run on past
+   # the next place a tokenizer starts, and neighbouring repeats never match
+   # the same character, so a failed match can't backtrack. A hostile post
+   # still scans in linear time.
+   tokenizers = [
+      r'a name="(?P<MESG_ID>\d+)"',
+      r'<strong>(?P<MESG_NUM>\d+)?(?:[^\d"<\n][^"<\n]*)?'
+         r'"(?P<MESG_TITLE>(?:[^"<\n]|"(?!</strong>))*)"</strong>',
+      r'<p class="dcmessage">'
+         r'(?P<MESG_TEXT>[^<]*(?:<(?!/p>|p class="dcmessage">)[^<]*)*)</p>',
+      r'class="dcdate">(?P<MESG_DATE>[^<>\n]*)(?=<)',
+      r'Reply # (?P<MESG_PARENT>\d+)',
+      r'src="(?P<AUTHOR_AVATAR>[^"\n]*)"(?= height="60")',
+      r'class="dcauthorinfo">'
+         r'(?:(?P<AUTHOR_CHARTER>Charter member)(?=<)'
+         r'|Member since (?P<AUTHOR_NEWBIE>[^<>\n]*)(?=<))?'
+         r'(?:[^\d"\n]*(?:\d+[^\d"\n]+)*?(?P<AUTHOR_POSTS>\d+)(?= post))?',
+      r'user_profiles&u_id=(?P<AUTHOR_ID>\d+)"(?=\s*class)',
+      r'class="dcauthorlink">(?P<AUTHOR_NAME>[^<>\n]*)(?=<)',
+   ]
+
+# Maps tokenizer group names to token types
+_NAME_TO_ID = dict((name, value) for name, value in vars(Token).iteritems()
+                   if name.isupper())
+
+Token.combined, Token.groups = compile_tokenizers(Token.tokenizers,
+                                                  _NAME_TO_ID)
+
+
+def tokenize(html):
+   """ Yields a (token type, data) pair for every token in the HTML, in source
+   order. Match objects hold a reference to the whole HTML, so they are
+   unpacked and dropped here rather than passed on. """
+
+   get_groups = Token.groups.get
+   for match in Token.combined.finditer(html):
+      for type, group in get_groups(match.lastindex, ()):
+         data = match.group(group)
+         if data is not None:
+            yield type, data
 
 
 class ThreadParser(object):
@@ -103,20 +247,28 @@ class ThreadParser(object):
 
    def __init__(self, html):
       self.html = html
-      self.replies = []
 
-      # Do all the dirty work
-      self.title = re.search('<strong>\s*"(.*?)"\s*</strong>', self.html).group(1)
-      self.forum_id = re.search('forum=(\d+)', self.html).group(1)
-      self.topic_id = re.search('topic_id=(\d+)', self.html).group(1)
-      self.parse()
+      # Only the cheap thread metadata is pulled out up front. The replies are
+      # parsed the first time they're asked for.
+      self.title = _TITLE_RE.search(self.html).group(1)
+      self.forum_id = _FORUM_RE.search(self.html).group(1)
+      self.topic_id = _TOPIC_RE.search(self.html).group(1)
+
+      # Every reply's URL shares everything up to the message id, so the ids
+      # are converted and formatted once here rather than once per reply
+      self.url_prefix = reply_url_prefix(self.forum_id, self.topic_id)
 
-      self.get_replies()
+      self._replies = None
+
+   @property
+   def replies(self):
+      """ List of all the replies in the thread, parsed on first access. """
 
-      # And reap the benefits
-      #self.thread = dict((p.num, p) for p in self.replies)
+      if self._replies is None:
+         self._replies = list(self.get_replies())
+      return self._replies
 
-   def parse(self):
+   def get_replies(self):
       """ OKP's HTML is extremely fragile, non-standard, and even inconsistent
       within a single post. You cannot count on every reply in a thread having,
       for instance, a title, author, and post number. The backend software is
@@ -125,59 +277,62 @@ class ThreadParser(object):
       since been deleted will have different HTML than a still-active user).
 
       My strategy here is to parse ALL post-related data from the HTML, along
-      with a special marker token (Token.BREAKER) that reliably marks the end of
+      with a special marker (Token.breaker) that reliably marks the end of
       a post. This datum tends to be stable even when other data is broken. I
       can then chunk all of the data into individual posts, using the marker as
       a boundary, and try to create a post from a chunk of data. Where
       constructing a post object with the data fails, I can discard the data and
-      continue. """
-
-      # Grab all the post data
-      self.tokens = []
-      for type, tokenizer in Token.tokenizers.iteritems():
-         for match in re.finditer(tokenizer, self.html):
-            self.tokens.append (
-               Token (
-                  type = type,
-                  data = match.group(1),
-                  position = match.start()
-               )
-            )
-
-      # Return to HTML source order, so we can break into posts later
-      self.tokens.sort(key = lambda x: x.position)
-
-   def iter_posts(self):
-      """ Returns groups of tokens corresponding to posts """
-
-      group = []
-      for token in self.tokens:
-         if token.type != Token.BREAKER:
-            group.append(token)
-         elif group:
-            yield group
-            group = []
+      continue.
 
-   def get_replies(self):
-      for post in self.iter_posts():
-         try:
-            reply = Reply(self.forum_id, self.topic_id)
-            reply.consume(post)
-            self.replies.append(reply)
-         except Exception, e:
-            raise e
+      The HTML is cut at each marker in turn, one post at a time, and each
+      post's chunk is tokenized on its own, straight into the reply being
+      built. Replies are yielded as soon as they are complete. """
+
+      handlers = Reply._HANDLERS
+      first = True
+
+      html = self.html
+      breaker = Token.breaker
+      start = 0
+      end = html.find(breaker)
+
+      # Whatever follows the last marker is page footer, not a post
+      while end != -1:
+         post = html[start:end]
+         start = end + len(breaker)
+         end = html.find(breaker, start)
+
+         reply = None
+         for type, data in tokenize(post):
+            if reply is None:
+               reply = Reply(self.forum_id, self.topic_id,
+                             self.url_prefix)
+            handlers[type](reply, data)
+
+         if reply is None:
+            continue
+         reply.finish()
+
+         # The root reply has no number or parent of its own
+         if first:
+            reply.message_num = 0
+            reply.message_parent = -1
+            first = False
 
-      self.replies[0].message_num = 0
-      self.replies[0].message_parent = -1
+         yield reply
 
 class Reply(object):
    """ Class representing a single reply in a post. Check out the __init__
    function to see which fields are available after parsing. """
 
-   def __init__(self, forum_id, topic_id):
+   def __init__(self, forum_id, topic_id, url_prefix=None):
       self.forum_id = forum_id
       self.topic_id = topic_id
 
+      if url_prefix is None:
+         url_prefix = reply_url_prefix(self.forum_id, self.topic_id)
+      self.url_prefix = url_prefix
+
       # models.Reply does not require most of these fields to have meaningful
       # values, but Reply.from_parse does assume that they are all defined
       self.message_id = None
@@ -194,81 +349,102 @@ class Reply(object):
       self.author_num_posts = 0
       self.url = ''
 
+      # Chunks of message text, joined into message_text by finish()
+      self.message = []
+
    def consume(self, post):
-      """ A 'post' is a list of Tokens. Not all posts will have all tokens
-      present. In fact, no posts will have all tokens present, since some pairs
-      of tokens are mutually exclusive within a single post. 
+      """ A 'post' is a sequence of (token type, data) pairs, as produced by
+      tokenize(). Not all posts will have all tokens present. In fact, no posts
+      will have all tokens present, since some pairs of tokens are mutually
+      exclusive within a single post.
 
       This function takes what tokens are present and assigns values to it's own
       fields where it can. """
 
-      self.message = []
+      handlers = self._HANDLERS
+      for type, data in post:
+         handlers[type](self, data)
 
-      for token in post:
+      self.finish()
 
-         if token.type == Token.MESG_ID:
-            self.message_id = int(token.data)
+   def finish(self):
+      """ Fills in the fields derived from the tokens once they have all been
+      consumed. """
 
-         elif token.type == Token.MESG_TITLE:
-            self.message_title = token.data
+      self.message_text = ''.join(self.message)
 
-         elif token.type == Token.MESG_PARENT:
-            self.message_parent = int(token.data)
+      self.url = '%s#%d' % (self.url_prefix, self.message_id)
 
-         elif token.type == Token.MESG_TEXT:
-            self.message.append(token.data)
-           
-         elif token.type == Token.MESG_DATE:
-            self.message_date = datetime.datetime.strptime(token.data[4:], "%b-%d-%y %I:%M %p")
-            self.message_date += get_default_time_offset()
+   # Token handlers. Each one assigns a single token's data to this reply.
 
-         elif token.type == Token.MESG_NUM:
-            self.message_num = int(token.data)
+   def _h_message_id(self, data):
+      self.message_id = int(data)
 
-         elif token.type == Token.AUTHOR_NAME:
-            self.author_name = token.data
+   def _h_message_title(self, data):
+      self.message_title = data
 
-         elif token.type == Token.AUTHOR_AVATAR:
+   def _h_message_parent(self, data):
+      self.message_parent = int(data)
 
-            # Moderator (^ok) images might also be caught, but they'll have
-            # relative paths
-            img = token.data.lower()
-            if (img.startswith('http') and img.endswith(('jpg','gif','png'))):
-               self.author_avatar = img
+   def _h_message_text(self, data):
+      self.message.append(data)
 
-         elif token.type == Token.AUTHOR_ID:
-            self.author_id = int(token.data)
+   def _h_message_date(self, data):
+      self.message_date = _reply_date(data[4:])
 
-         elif token.type == Token.AUTHOR_CHARTER:
-            self.author_is_charter = True
-            self.author_join_date = False
+   def _h_message_num(self, data):
+      self.message_num = int(data)
 
-         elif token.type == Token.AUTHOR_NEWBIE:
-            self.author_join_date = re.sub(r'st|nd|rd|th', '', token.data)
-            self.author_join_date = datetime.datetime.strptime(self.author_join_date, '%b %d %Y')
-            self.author_is_charter = False
+   def _h_author_name(self, data):
+      self.author_name = data
 
-         elif token.type == Token.AUTHOR_POSTS:
-            self.author_num_posts = int(token.data)
+   def _h_author_avatar(self, data):
+      # Moderator (^ok) images might also be caught, but they'll have
+      # relative paths
+      if _AVATAR_RE.match(data):
+         self.author_avatar = data.lower()
 
-      self.message_text = ''.join(self.message)
+   def _h_author_id(self, data):
+      self.author_id = int(data)
 
-      self.url = REPLY_URL % (int(self.forum_id),
-                                  int(self.topic_id),
-                                  int(self.message_id))
+   def _h_author_charter(self, data):
+      self.author_is_charter = True
+      self.author_join_date = False
+
+   def _h_author_newbie(self, data):
+      self.author_join_date = _parse_join_date(data)
+      self.author_is_charter = False
+
+   def _h_author_posts(self, data):
+      self.author_num_posts = int(data)
+
+   _HANDLERS = {
+      Token.MESG_ID        : _h_message_id,
+      Token.MESG_TITLE     : _h_message_title,
+      Token.MESG_PARENT    : _h_message_parent,
+      Token.MESG_TEXT      : _h_message_text,
+      Token.MESG_DATE      : _h_message_date,
+      Token.MESG_NUM       : _h_message_num,
+      Token.AUTHOR_NAME    : _h_author_name,
+      Token.AUTHOR_AVATAR  : _h_author_avatar,
+      Token.AUTHOR_ID      : _h_author_id,
+      Token.AUTHOR_CHARTER : _h_author_charter,
+      Token.AUTHOR_NEWBIE  : _h_author_newbie,
+      Token.AUTHOR_POSTS   : _h_author_posts,
+   }
+
+   # Fields shown by __str__, in order
+   _FIELDS = (
+      'forum_id', 'topic_id', 'message_id', 'message_date', 'message_num',
+      'message_parent', 'message_title', 'message_text',
+      'author_name', 'author_id', 'author_join_date', 'author_num_posts',
+      'author_is_charter',
+   )
 
    def __str__(self):
-      fields = 'forum_id topic_id message_id message_date message_num '
-      fields += 'message_parent message_title message_text '
-      fields += 'author_name author_id author_join_date author_num_posts author_is_charter'
-      fields = fields.split()
-
-      s = u''
-      for field in fields:
-         if field in self.__dict__:
-            value = self.__dict__[field]
-            s += "%-20s: %s\n" % (field, unicode(self.__dict__[field])[:40])
-      return s
+      return u''.join("%-20s: %s\n" % (field,
+                                        unicode(getattr(self, field))[:40])
+                      for field in self._FIELDS)
 
    @property
    def dict(self):
@@ -316,6 +492,41 @@ def parse_links(tp, needle=None, unique=False):
             links[reply.author_id].append(link)
    return links
 
+def _parse_thread(html):
+   """ Worker for parse_many. Replies are parsed lazily, so touch them here,
+   in the worker process. Everything returned is pickled back to the parent,
+   so leave out what the parent already has or doesn't need: the HTML itself,
+   and each reply's message chunks, which message_text already holds. """
+
+   tp = ThreadParser(html)
+   for reply in tp.replies:
+      reply.message = []
+   tp.html = None
+   return tp
+
+def parse_many(htmls, workers=None, chunksize=16):
+   """ Parses many threads in parallel, across a pool of worker processes (one
+   per CPU unless workers is given). Returns a list of ThreadParsers, in the
+   same order as htmls, with their replies already parsed. Each reply's
+   message holds its whole message_text as one chunk, rather than the
+   individual chunks ThreadParser would have produced. """
+
+   htmls = list(htmls)
+   pool = multiprocessing.Pool(workers)
+   try:
+      parsers = pool.map(_parse_thread, htmls, chunksize)
+   finally:
+      pool.close()
+      pool.join()
+
+   # The workers don't send the HTML or message chunks back. Reattach the
+   # caller's HTML, and give each reply its text as a single chunk.
+   for tp, html in zip(parsers, htmls):
+      tp.html = html
+      for reply in tp.replies:
+         reply.message = [reply.message_text]
+   return parsers
+
 def show_author_ids(tp):
    for id in set(r.author_id for r in tp.replies):
       print id